@@ -1,109 +1,220 @@
 #!/usr/bin/env python3
 
 import argparse
-import inspect
-import io
-import json
 import os
-import requests
-import urllib
 import re
 import shutil
+import signal
+import stat
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
-from contextlib import suppress
+from contextlib import contextmanager, suppress
+from functools import cached_property
 from pathlib import Path
-from zipfile import ZipFile
-
-user_chrome_contents = inspect.cleandoc(
-    """
-    /* #nav-bar, #identity-box, #tabbrowser-tabs, #TabsToolbar { */
-    /*     visibility: collapse !important;                      */
-    /* }                                                         */
-    """
-)
-
-user_js_contents = inspect.cleandoc(
-    """
-    user_pref("browser.cache.disk.enable", false);
-    user_pref("browser.cache.disk.capacity", 0);
-    user_pref("browser.cache.disk.filesystem_reported", 1);
-    user_pref("browser.cache.disk.smart_size.enabled", false);
-    user_pref("browser.cache.disk.smart_size.first_run", false);
-    user_pref("browser.cache.disk.smart_size.use_old_max", false);
-    user_pref("browser.ctrlTab.previews", true);
-    user_pref("browser.tabs.warnOnClose", false);
-    user_pref("plugin.state.flash", 2);
-    user_pref("toolkit.legacyUserProfileCustomizations.stylesheets", true);
-    user_pref("doh-rollout.doneFirstRun", true);
-    """
-)
-
-desktop_file_contents = inspect.cleandoc(
-    """
-    [Desktop Entry]
-    Version=1.0
-    Name={name}
-    Comment=Comment here
-    GenericName=Generic Name here
-    Keywords=Semicolon-separated keywords
-    Exec={command}
-    Terminal=false
-    X-MultipleArgs=false
-    Type=Application
-    Icon={icon}
-    Categories=Accessories
-    MimeType=
-    StartupNotify=true
-    StartupWMClass={wm_class}
-    """
-)
+
+# Scheme prefix removed from the url when deriving a default name.
+url_scheme_pattern = re.compile(r"^https?://")
+
+# (connect, read) timeouts, in seconds, for all HTTP requests.
+request_timeout = (3.05, 30)
+
+# Metadata for the current release of uBlock Origin.
+ublock_api_url = "https://addons.mozilla.org/api/v5/addons/addon/ublock-origin/"
+
+# How long, in seconds, a previously downloaded .xpi may be reused.
+ublock_cache_lifetime = 24 * 60 * 60
+
+# How long, in seconds, a favicon is used before revalidating it.
+favicon_cache_lifetime = 7 * 24 * 60 * 60
+
+user_chrome_contents = b"""\
+/* #nav-bar, #identity-box, #tabbrowser-tabs, #TabsToolbar { */
+/*     visibility: collapse !important;                      */
+/* }                                                         */
+"""
+
+user_js_contents = b"""\
+user_pref("browser.cache.disk.enable", false);
+user_pref("browser.cache.disk.capacity", 0);
+user_pref("browser.cache.disk.filesystem_reported", 1);
+user_pref("browser.cache.disk.smart_size.enabled", false);
+user_pref("browser.cache.disk.smart_size.first_run", false);
+user_pref("browser.cache.disk.smart_size.use_old_max", false);
+user_pref("browser.ctrlTab.previews", true);
+user_pref("browser.tabs.warnOnClose", false);
+user_pref("plugin.state.flash", 2);
+user_pref("toolkit.legacyUserProfileCustomizations.stylesheets", true);
+user_pref("doh-rollout.doneFirstRun", true);
+"""
+
+
+def _render_desktop_file(name, command, icon, wm_class):
+    return f"""\
+[Desktop Entry]
+Version=1.0
+Name={name}
+Comment=Comment here
+GenericName=Generic Name here
+Keywords=Semicolon-separated keywords
+Exec={command}
+Terminal=false
+X-MultipleArgs=false
+Type=Application
+Icon={icon}
+Categories=Accessories
+MimeType=
+StartupNotify=true
+StartupWMClass={wm_class}
+"""
+
+
+def _write_once(path, data):
+    # Creating the file exclusively checks for an existing file as
+    # part of the open, without a separate stat.
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        return
+
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def _atomic_open(path):
+    # Write to a temporary file first, so that readers never observe
+    # a partially written file.
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with open(fd, "wb") as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+
+def _fast_rmtree(path, dir_fd=None):
+    # Equivalent to shutil.rmtree, but relies on the file type reported
+    # by scandir and removes entries relative to an open directory
+    # descriptor, avoiding a stat and a full path lookup per entry.
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=dir_fd)
+    try:
+        with os.scandir(fd) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    _fast_rmtree(entry.name, dir_fd=fd)
+                else:
+                    os.unlink(entry.name, dir_fd=fd)
+    finally:
+        os.close(fd)
+
+    os.rmdir(path, dir_fd=dir_fd)
 
 
 class SsbFirefox:
-    def __init__(self, url, name=None):
+    def __init__(self, url, name=None, offline=False):
         self.url = url
+        self.offline = offline
+
+        # The session is created on first use, which may happen from
+        # several worker threads at once.
+        self._session_lock = threading.Lock()
+        self._session_instance = None
 
         if name is None:
-            self.name = (
-                self.url.replace("http://", "")
-                .replace("https://", "")
-                .replace("/", "_")
-            )
+            self.name = url_scheme_pattern.sub("", self.url).replace("/", "_")
         else:
             self.name = name
 
     @property
+    def _session(self):
+        with self._session_lock:
+            if self._session_instance is None:
+                self._session_instance = self._make_session()
+            return self._session_instance
+
+    def _make_session(self):
+        # Imported here, as requests is slow to import and isn't
+        # needed at all once the profile has been set up.
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        session = requests.Session()
+        session.headers["Accept-Encoding"] = "gzip"
+        session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=4,
+                max_retries=Retry(total=3, backoff_factor=0.3),
+            ),
+        )
+        return session
+
+    @cached_property
     def config_path(self):
         return Path.home().joinpath(".local", "share", "ssb", self.name)
 
-    @property
+    @cached_property
     def profile_path(self):
         return self.config_path / "profile"
 
+    @cached_property
+    def cache_path(self):
+        return Path.home().joinpath(".cache", "ssb")
+
+    @cached_property
+    def _xpi_cache_path(self):
+        return self.cache_path / "ublock.xpi"
+
+    @cached_property
+    def _xpi_cache_sentinel(self):
+        # Holds the extension id from the cached .xpi's manifest.json
+        return self.cache_path / "ublock.id"
+
     def generate_profile(self):
+        self._ensure_dirs()
         self.make_user_css()
         self.make_user_js()
-        self.install_ublock_origin()
+        if not self.offline:
+            self.install_ublock_origin()
+
+    def _ensure_dirs(self):
+        # Create every directory the profile needs up front, rather
+        # than in each of the tasks that write into them.
+        os.makedirs(self.profile_path / "chrome", exist_ok=True)
+        os.makedirs(self.profile_path / "extensions", exist_ok=True)
+
+    def _submit_profile_tasks(self, executor):
+        self._ensure_dirs()
+
+        # The uBlock Origin install resolves the .xpi URL and then
+        # downloads it within the same task, so the download is chained
+        # onto the lookup while the other steps proceed independently.
+        futures = [
+            executor.submit(self.make_user_css),
+            executor.submit(self.make_user_js),
+        ]
+        if not self.offline:
+            futures.append(executor.submit(self.install_ublock_origin))
+        return futures
 
     def make_user_css(self):
         user_chrome = self.profile_path.joinpath("chrome", "userChrome.css")
-        if user_chrome.exists():
-            return
-
-        user_chrome.parent.mkdir(parents=True, exist_ok=True)
-        with open(user_chrome, "w") as f:
-            f.write(user_chrome_contents)
+        _write_once(user_chrome, user_chrome_contents)
 
     def make_user_js(self):
         user_js = self.profile_path.joinpath("user.js")
-        if user_js.exists():
-            return
-
-        user_js.parent.mkdir(parents=True, exist_ok=True)
-        with open(user_js, "w") as f:
-            f.write(user_js_contents)
+        _write_once(user_js, user_js_contents)
 
     def install_ublock_origin(self):
         # Look for a sentinel file instead of the extension itself,
@@ -115,55 +226,142 @@ class SsbFirefox:
         if sentinel_file.exists():
             return
 
-        # First, look in the addon page to find the correct URL.
-        addon_url = "https://addons.mozilla.org/en-US/firefox/addon/ublock-origin/"
-        res = requests.get(addon_url)
-        res.raise_for_status()
+        # The .xpi is downloaded once into a cache shared by all
+        # profiles, and only refreshed once it becomes stale.
+        extension_id = self._cached_ublock_extension_id()
+        if extension_id is None:
+            link = self._resolve_ublock_xpi_url()
+            extension_id = self._download_and_save_xpi(link)
 
-        html = res.content.decode("utf-8")
-        for match in re.finditer('href="(?P<link>.*?)"', html):
-            link = match.group("link")
-            if link.endswith(".xpi") and "ublock" in link:
-                break
-        else:
-            raise RuntimeError("Could not find .xpi file for ublock origin")
+        # Then hardlink the cached .xpi into the location given by
+        # manifest.json, copying it if the cache is on another device.
+        ublock_origin_xpi = sentinel_file.with_name(extension_id + ".xpi")
+        with suppress(FileNotFoundError):
+            os.remove(ublock_origin_xpi)
+        try:
+            os.link(self._xpi_cache_path, ublock_origin_xpi)
+        except OSError:
+            shutil.copyfile(self._xpi_cache_path, ublock_origin_xpi)
+
+        _write_once(sentinel_file, b"")
+
+    def _cached_ublock_extension_id(self):
+        with suppress(FileNotFoundError):
+            age = time.time() - self._xpi_cache_path.stat().st_mtime
+            if age < ublock_cache_lifetime:
+                return self._xpi_cache_sentinel.read_text().strip() or None
+
+        return None
 
-        # Next, download the .xpi for the extension.
-        res = requests.get(link)
+    def _resolve_ublock_xpi_url(self):
+        res = self._session.get(
+            ublock_api_url,
+            headers={"Accept": "application/json"},
+            timeout=request_timeout,
+        )
         res.raise_for_status()
 
-        # Read the manifest.json to determine where it needs to be saved.
-        with io.BytesIO(res.content) as data_file:
-            zipfile = ZipFile(data_file)
-            manifest = json.loads(zipfile.read("manifest.json").decode("utf-8"))
+        return res.json()["current_version"]["file"]["url"]
+
+    def _download_and_save_xpi(self, link):
+        import json
+        from zipfile import ZipFile
+
+        cached_xpi = self._xpi_cache_path
+        cached_xpi.parent.mkdir(parents=True, exist_ok=True)
+
+        # Stream the .xpi to a temporary file alongside its final
+        # location, so that an interrupted download never leaves a
+        # partial extension in the cache.
+        fd, tmp_path = tempfile.mkstemp(dir=cached_xpi.parent, suffix=".tmp")
+        try:
+            with open(fd, "wb") as tmp, self._session.get(
+                link, timeout=request_timeout, stream=True
+            ) as res:
+                res.raise_for_status()
+                res.raw.decode_content = True
+                shutil.copyfileobj(res.raw, tmp, length=1 << 16)
+
+            # Read the manifest.json to determine where it needs to be saved.
+            with ZipFile(tmp_path) as zipfile:
+                manifest = json.loads(zipfile.read("manifest.json").decode("utf-8"))
             extension_id = manifest["browser_specific_settings"]["gecko"]["id"]
 
-        # Then save the .xpi file in the location given.
-        ublock_origin_xpi = sentinel_file.with_name(extension_id + ".xpi")
-        ublock_origin_xpi.parent.mkdir(parents=True, exist_ok=True)
-        with open(ublock_origin_xpi, "wb") as f:
-            f.write(res.content)
+            os.replace(tmp_path, cached_xpi)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            raise
+
+        self._xpi_cache_sentinel.write_text(extension_id)
 
-        with open(sentinel_file, "w") as f:
-            pass
+        return extension_id
 
     def download_icon(self):
+        # Only revalidate the favicon with the server once it is stale.
+        with suppress(FileNotFoundError):
+            age = time.time() - self.favicon_path.stat().st_mtime
+            if age < favicon_cache_lifetime:
+                return
+
+        try:
+            self._refresh_icon()
+        except OSError as err:
+            # A missing favicon shouldn't prevent the rest of the setup.
+            # This includes requests.RequestException, a subclass of
+            # OSError.
+            print(f"Could not download favicon: {err}", file=sys.stderr)
+
+    def _refresh_icon(self):
+        from email.utils import formatdate
+        from urllib.parse import urlparse
+
         favicon = self.favicon_path
-        if not favicon.exists():
-            favicon.parent.mkdir(parents=True, exist_ok=True)
-            parsed = urllib.parse.urlparse(self.url)
-            favicon_url = f"https://{parsed.hostname}/favicon.ico"
-            res = requests.get(favicon_url)
+        etag_file = self.favicon_etag_path
 
-            with open(favicon, "wb") as f:
-                f.write(res.content)
+        # normalize_url leaves urls starting with "http" untouched, so
+        # a bare host such as "httpbin.org" has no hostname to fetch from.
+        hostname = urlparse(self.url).hostname
+        if hostname is None:
+            return
+        favicon_url = f"https://{hostname}/favicon.ico"
 
-    @property
+        headers = {}
+        if favicon.exists():
+            headers["If-Modified-Since"] = formatdate(
+                favicon.stat().st_mtime, usegmt=True
+            )
+            with suppress(FileNotFoundError):
+                headers["If-None-Match"] = etag_file.read_text()
+
+        with self._session.get(
+            favicon_url, headers=headers, timeout=request_timeout, stream=True
+        ) as res:
+            res.raise_for_status()
+            if res.status_code == 304:
+                os.utime(favicon)
+                return
+
+            # iter_content wraps errors raised partway through the body
+            # as requests exceptions, unlike reading from res.raw.
+            with _atomic_open(favicon) as f:
+                for chunk in res.iter_content(1 << 16):
+                    f.write(chunk)
+
+        etag = res.headers.get("ETag")
+        if etag is None:
+            with suppress(FileNotFoundError):
+                os.remove(etag_file)
+        else:
+            with _atomic_open(etag_file) as f:
+                f.write(etag.encode("utf-8"))
+
+    @cached_property
     def command(self):
         return [
             "firefox",
             "-profile",
-            self.profile_path,
+            str(self.profile_path),
             "-no-remote",
             "-new-instance",
             self.url,
@@ -171,29 +369,46 @@ class SsbFirefox:
             self.wm_class,
         ]
 
-    @property
+    @cached_property
+    def firefox_binary(self):
+        binary = shutil.which(self.command[0])
+        if binary is None:
+            raise FileNotFoundError(self.command[0])
+        return binary
+
+    @cached_property
     def favicon_path(self):
         return self.config_path / "favicon.ico"
 
-    @property
+    @cached_property
+    def favicon_etag_path(self):
+        return self.favicon_path.with_suffix(".etag")
+
+    @cached_property
     def wm_class(self):
         return f"SSB_{self.name}"
 
-    @property
+    @cached_property
     def desktop_file_symlink(self):
         return Path.home().joinpath(
             ".local", "share", "applications", f"{self.name}.desktop"
         )
 
-    @property
+    @cached_property
     def desktop_file(self):
         return self.config_path / "application-menu-item.desktop"
 
     def generate_desktop_file(self):
+        from concurrent.futures import ThreadPoolExecutor
+
         symlink = self.desktop_file_symlink
         target = self.desktop_file
         relpath = os.path.relpath(target, symlink.parent)
 
+        # Whether the menu entries have changed, requiring the
+        # desktop database to be rebuilt.
+        changed = False
+
         if symlink.is_symlink():
             # Don't overwrite an existing symlink
             # that points somewhere else.
@@ -203,42 +418,113 @@ class SsbFirefox:
             raise FileExistsError(symlink)
         else:
             symlink.symlink_to(relpath)
+            changed = True
 
-        self.generate_profile()
-        self.download_icon()
-        with open(target, "w") as f:
-            f.write(
-                desktop_file_contents.format(
-                    name=self.name,
-                    command=" ".join(str(s) for s in self.command),
-                    icon=self.favicon_path,
-                    wm_class=self.wm_class,
-                )
-            )
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = self._submit_profile_tasks(executor)
+            if not self.offline:
+                futures.append(executor.submit(self.download_icon))
+
+        for future in futures:
+            future.result()
+
+        contents = _render_desktop_file(
+            name=self.name,
+            command=" ".join(str(s) for s in self.command),
+            icon=self.favicon_path,
+            wm_class=self.wm_class,
+        ).encode("utf-8")
+
+        with suppress(FileNotFoundError):
+            if target.read_bytes() == contents:
+                return changed
+
+        fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, contents)
+        finally:
+            os.close(fd)
+
+        return True
 
     def reload_desktop_files(self):
-        subprocess.check_call(['update-desktop-database', str(self.desktop_file_symlink.parent)])
+        # Rebuilding the database can take a noticeable amount of time,
+        # and nothing needs to wait for it to finish.
+        subprocess.Popen(
+            ["update-desktop-database", str(self.desktop_file_symlink.parent)],
+            start_new_session=True,
+        )
 
     def clean(self):
         with suppress(FileNotFoundError):
-            shutil.rmtree(self.config_path)
+            _fast_rmtree(self.config_path)
         with suppress(FileNotFoundError):
             os.remove(self.desktop_file)
 
+    @cached_property
+    def runtime_cache_path(self):
+        runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+        return Path(runtime_dir) / f"ssb-{self.name}-cache"
+
+    def link_cache_dir(self):
+        # Firefox's disk cache is discarded after every run, so keep it
+        # in the (usually tmpfs-backed) runtime directory, rather than
+        # deleting thousands of small files from the profile on exit.
+        cache_dir = self.runtime_cache_path
+        cache_dir.mkdir(mode=0o700, exist_ok=True)
+
+        # Without XDG_RUNTIME_DIR, the cache directory has a predictable
+        # name in the shared temporary directory.  Refuse to use it
+        # unless it is a private directory owned by this user.
+        st = os.lstat(cache_dir)
+        if (
+            not stat.S_ISDIR(st.st_mode)
+            or st.st_uid != os.getuid()
+            or st.st_mode & 0o077
+        ):
+            raise PermissionError(
+                f"Cache directory {cache_dir} is not private to the current user"
+            )
+
+        cache2 = self.profile_path / "cache2"
+        if cache2.is_symlink():
+            if cache2.resolve() == cache_dir.resolve():
+                return
+            cache2.unlink()
+        elif cache2.exists():
+            _fast_rmtree(cache2)
+
+        cache2.symlink_to(cache_dir)
+
     def run(self):
         self.generate_profile()
+        self.link_cache_dir()
         try:
-            subprocess.check_call(self.command)
+            # posix_spawn avoids fork's copy-on-write setup of this
+            # process before exec'ing firefox.
+            pid = os.posix_spawn(self.firefox_binary, self.command, os.environ)
+            try:
+                _, status = os.waitpid(pid, 0)
+            except BaseException:
+                # As subprocess.call does, don't leave firefox running
+                # or unreaped if interrupted while waiting.
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+                raise
+            returncode = os.waitstatus_to_exitcode(status)
+            if returncode:
+                raise subprocess.CalledProcessError(returncode, self.command)
         finally:
-            shutil.rmtree(self.profile_path.joinpath("cache2"))
+            with suppress(OSError):
+                _fast_rmtree(self.runtime_cache_path)
 
 
 def main(args):
-    ssb = SsbFirefox(args.url, args.name)
+    ssb = SsbFirefox(args.url, args.name, offline=args.offline)
 
     if args.mode == "application-menu":
-        ssb.generate_desktop_file()
-        ssb.reload_desktop_files()
+        if ssb.generate_desktop_file():
+            ssb.reload_desktop_files()
     elif args.mode == "run":
         ssb.run()
     elif args.mode == "clean":
@@ -277,6 +563,15 @@ def arg_main():
     parser.add_argument(
         "-n", "--name", help="The unique name for the single-site browser"
     )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help=(
+            "Skip all network access.  "
+            "uBlock Origin and the favicon are not installed or updated, "
+            "but will be on the next run without this flag."
+        ),
+    )
     parser.add_argument(
         "--pdb",
         action="store_true",